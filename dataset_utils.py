@@ -3,6 +3,11 @@ import os
 import pickle
 import hashlib
 import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import time
 import numpy as np
@@ -48,6 +53,16 @@ class DatasetGeneratorConfig():
     # Number of images per parallel job
     JOBLENGTH = 2000
 
+    # Number of parallel workers (joblib n_jobs, -1 = all cores)
+    N_JOBS = -1
+
+    # Render all targets of a job in one vectorized pass instead of one PIL
+    # chain per sample. Images and segmentations stay identical, only the
+    # target rendering differs slightly.
+    BATCH_TARGETS = False
+    # Number of augmented targets per sample, > 1 implies BATCH_TARGETS
+    TARGETS_PER_SAMPLE = 1
+
     BBOX_DIMS = 4
 
     NUM_CLASSES = 20
@@ -55,6 +70,12 @@ class DatasetGeneratorConfig():
     DATA_PATH = ''
     PREFIX = 'CLUTTERED_OMNIGLOT'
 
+    # Local cache of generated datasets, disabled if empty
+    CACHE_PATH = ''
+    # Evict least recently used datasets above this size (bytes),
+    # larger datasets are not cached
+    CACHE_SIZE = 20*2**30
+
     def set_drawer_split(self):
         
             #split char instances
@@ -271,6 +292,10 @@ def make_cluttered_image_bbox(chars, n_distractors, config, verbose=0):
         #initialize image and segmentation mask
         im = Image.new('RGBA', (config.IMAGE_WIDTH,config.IMAGE_HEIGHT), (0,0,0,255))
         r_bbox = np.zeros((n_distractors,config.BBOX_DIMS+1), dtype='uint8')
+        # instance-ID label map (0 = background, j+1 = j-th pasted character)
+        # and number of pixels each character covered when it was pasted
+        lbl = np.zeros((im.size[1],im.size[0]), dtype='uint16')
+        r_area = np.zeros((n_distractors,), dtype='uint16')
         # seg = Image.new('RGBA', (config.IMAGE_WIDTH,config.IMAGE_HEIGHT), (0,0,0,255))
 
         #generate background clutter
@@ -300,6 +325,10 @@ def make_cluttered_image_bbox(chars, n_distractors, config, verbose=0):
             ymax = ymin + tmp_im.size[1]
             # add augmented random character to image
             im.paste(tmp_im,(xmin,ymin,xmax,ymax),mask=tmp_im)
+            # draw the same mask into the label map, later pastes overwrite it
+            stuff = np.asarray(tmp_im)[:,:,3] > 0
+            lbl[ymin:ymax,xmin:xmax][stuff] = j+1
+            r_area[j] = stuff.sum()
             # add bbox annotations
             # r_bbox[j,:] = np.array([
             #     max(0,xmin-1),
@@ -378,7 +407,7 @@ def make_cluttered_image_bbox(chars, n_distractors, config, verbose=0):
         
         l=l+1
         
-    return im, r_bbox
+    return im, r_bbox, lbl, r_area
 
 def make_target(chars, char, config, verbose=0):
     '''Inputs:
@@ -416,10 +445,67 @@ def make_target(chars, char, config, verbose=0):
         
     return im
 
+# Draw the augmentation of one target in the same order as make_target, so
+# the random stream and with it all following scene images stay the same
+def draw_target_params(config, random=np.random):
+    phi = random.uniform(-config.MAX_ROTATION, config.MAX_ROTATION)
+    theta = random.uniform(-config.MAX_SHEAR, config.MAX_SHEAR)
+    # scale factors, unused for targets (scale=1)
+    random.uniform(-1,1,size=2)
+    return phi, theta, random.rand(3)
+
+# Render augmented targets for a whole job at once
+def make_targets(glyphs, config, phi, theta, rnd):
+    '''Inputs:
+    glyphs: target character of each sample (equally sized binary images)
+    phi: (len(glyphs), n_targets) rotation of each target in degrees
+    theta: (len(glyphs), n_targets) shear of each target in degrees
+    rnd: (len(glyphs), n_targets, 3) color of each target
+    Outputs (len(glyphs), n_targets, TARGET_HEIGHT, TARGET_WIDTH, 3) targets.
+    Like make_target, characters are rotated and sheared but not scaled,
+    resized by 32/105 and colored. They are centered on the center of the
+    character's bounding box rather than cropped and pasted.'''
+    src = np.stack([np.asarray(g, dtype=bool) for g in glyphs])
+    B, src_h, src_w = src.shape
+
+    # centers of the characters' bounding boxes
+    rows = src.any(axis=2)
+    cols = src.any(axis=1)
+    cy = (rows.argmax(axis=1) + src_h - rows[:,::-1].argmax(axis=1)) / 2
+    cx = (cols.argmax(axis=1) + src_w - cols[:,::-1].argmax(axis=1)) / 2
+
+    phi = np.radians(phi)
+    theta = np.radians(theta)
+
+    # inverse of the rot_x/rot_y affine map, det = cos(2*theta)
+    det = np.cos(2*theta)[...,np.newaxis,np.newaxis]
+    c1, s1 = np.cos(phi+theta)[...,np.newaxis,np.newaxis], np.sin(phi+theta)[...,np.newaxis,np.newaxis]
+    c2, s2 = np.cos(phi-theta)[...,np.newaxis,np.newaxis], np.sin(phi-theta)[...,np.newaxis,np.newaxis]
+
+    # map every target pixel center back into its source character
+    scale = 32/105
+    u = ((np.arange(config.TARGET_WIDTH) + 0.5 - config.TARGET_WIDTH/2) / scale)[np.newaxis,:]
+    v = ((np.arange(config.TARGET_HEIGHT) + 0.5 - config.TARGET_HEIGHT/2) / scale)[:,np.newaxis]
+    xs = np.floor((c2*u - s2*v) / det + cx[:,np.newaxis,np.newaxis,np.newaxis]).astype('int64')
+    ys = np.floor((s1*u + c1*v) / det + cy[:,np.newaxis,np.newaxis,np.newaxis]).astype('int64')
+    inside = (xs >= 0) & (xs < src_w) & (ys >= 0) & (ys < src_h)
+    b = np.arange(B)[:,np.newaxis,np.newaxis,np.newaxis]
+    stuff = inside & src[b, np.clip(ys, 0, src_h-1), np.clip(xs, 0, src_w-1)]
+
+    return (stuff[...,np.newaxis] * rnd[:,:,np.newaxis,np.newaxis,:] * 255).astype('uint8')
+
+# Per-sample shape of the targets array, (height, width, 3) like the PIL targets
+def get_target_shape(config):
+    shape = (config.TARGET_HEIGHT,config.TARGET_WIDTH,3)
+    if config.TARGETS_PER_SAMPLE > 1:
+        shape = (config.TARGETS_PER_SAMPLE,) + shape
+    return shape
+
 def make_image(chars, 
                k, 
                config,
-               seed=None):
+               seed=None,
+               out_dir=None):
     '''Inputs:
     chars: Dataset of characters
     angle: legacy
@@ -428,15 +514,24 @@ def make_image(chars,
     joblength: number of images to create in each job
     k: job index
     seed: random seed to generate different results in each job
-    coloring: legacy'''
+    coloring: legacy
+    out_dir: If set, write into the job's slice of the memory-mapped outputs
+        in this directory and only return job metadata'''
+
+    t = time.time()
 
     # Generate random seed
     np.random.seed(seed)
 
     # Initialize batch data storage
-    r_ims = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
-    r_seg = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,1), dtype='uint8')
-    r_tar = np.zeros((config.JOBLENGTH,config.TARGET_WIDTH,config.TARGET_HEIGHT,3), dtype='uint8')
+    if out_dir is None:
+        r_ims = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
+        r_seg = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,1), dtype='uint8')
+        r_tar = np.zeros((config.JOBLENGTH,)+get_target_shape(config), dtype='uint8')
+    else:
+        r_ims, r_seg, r_tar = open_job_memmaps(out_dir, ['images', 'segmentation', 'targets'], k, config.JOBLENGTH)
+    batch_targets = config.BATCH_TARGETS or config.TARGETS_PER_SAMPLE > 1
+    tar_chars, tar_params = [], []
 
     for i in range(config.JOBLENGTH):
 
@@ -451,21 +546,40 @@ def make_image(chars,
         #generate images and segmentation masks
         ims, seg = make_cluttered_image(chars, char, n_distractors, config)
 
-        #generate targets
-        tar = make_target(chars, char, config)
-
         # Append to dataset
         r_ims[i,:,:,:] = ims
         r_seg[i,:,:,0] = seg
-        r_tar[i,:,:,:] = tar
 
-    return r_ims, r_seg, r_tar
+        #generate targets
+        if batch_targets:
+            tar_chars.append(char)
+            tar_params.append(draw_target_params(config))
+        else:
+            r_tar[i,...] = make_target(chars, char, config)
+
+    if batch_targets:
+        phi, theta, rnd = [np.array(p)[:,np.newaxis] for p in zip(*tar_params)]
+        # further targets come from their own stream, the scene images do
+        # not depend on TARGETS_PER_SAMPLE
+        n_extra = config.TARGETS_PER_SAMPLE - 1
+        if n_extra > 0:
+            extra = np.random.RandomState(None if seed is None else int(seed) ^ 0x7a26e75)
+            phi = np.concatenate([phi, extra.uniform(-config.MAX_ROTATION, config.MAX_ROTATION, size=(len(phi),n_extra))], axis=1)
+            theta = np.concatenate([theta, extra.uniform(-config.MAX_SHEAR, config.MAX_SHEAR, size=(len(theta),n_extra))], axis=1)
+            rnd = np.concatenate([rnd, extra.rand(len(rnd),n_extra,3)], axis=1)
+        tar = make_targets(tar_chars, config, phi, theta, rnd)
+        r_tar[...] = tar if config.TARGETS_PER_SAMPLE > 1 else tar[:,0]
+
+    if out_dir is None:
+        return r_ims, r_seg, r_tar
+    return close_job_memmaps([r_ims, r_seg, r_tar], k, config.JOBLENGTH, t)
 
 def make_image_bbox(
     chars,
     k,
     config,
-    seed=None
+    seed=None,
+    out_dir=None
 ):
     '''Inputs:
     chars: Dataset of characters
@@ -475,14 +589,23 @@ def make_image_bbox(
     joblength: number of images to create in each job
     k: job index
     seed: random seed to generate different results in each job
-    coloring: legacy'''
+    coloring: legacy
+    out_dir: If set, write into the job's slice of the memory-mapped outputs
+        in this directory and only return job metadata'''
+
+    t = time.time()
 
     # Generate random seed
     np.random.seed(seed)
 
     # Initialize batch data storage
-    r_ims = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
-    r_bboxes = np.zeros((config.JOBLENGTH,config.DISTRACTORS,config.BBOX_DIMS+1,1), dtype='uint8') # +1 on bbox dims for the cat id
+    if out_dir is None:
+        r_ims = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
+        r_bboxes = np.zeros((config.JOBLENGTH,config.DISTRACTORS,config.BBOX_DIMS+1,1), dtype='uint8') # +1 on bbox dims for the cat id
+        r_lbl = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT), dtype='uint16')
+        r_area = np.zeros((config.JOBLENGTH,config.DISTRACTORS), dtype='uint16')
+    else:
+        r_ims, r_bboxes, r_lbl, r_area = open_job_memmaps(out_dir, ['images', 'bboxes', 'labels', 'areas'], k, config.JOBLENGTH)
     # r_seg = np.zeros((config.JOBLENGTH,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,1), dtype='uint8')
     # r_tar = np.zeros((config.JOBLENGTH,config.TARGET_WIDTH,config.TARGET_HEIGHT,3), dtype='uint8')
 
@@ -497,7 +620,7 @@ def make_image_bbox(
         # selects the one fixed number of distractors in other cases
         n_distractors = np.random.choice([config.DISTRACTORS])
         #generate images and segmentation masks
-        ims, bboxes = make_cluttered_image_bbox(chars, n_distractors, config)
+        ims, bboxes, lbl, area = make_cluttered_image_bbox(chars, n_distractors, config)
 
         #generate targets
         # tar = make_target(chars, char, config)
@@ -505,9 +628,227 @@ def make_image_bbox(
         # Append to dataset
         r_ims[i,:,:,:] = ims
         r_bboxes[i,:,:,0] = bboxes
+        r_lbl[i,:,:] = lbl
+        r_area[i,:] = area
         # r_tar[i,:,:,:] = tar
 
-    return r_ims, r_bboxes
+    if out_dir is None:
+        return r_ims, r_bboxes, r_lbl, r_area
+    return close_job_memmaps([r_ims, r_bboxes, r_lbl, r_area], k, config.JOBLENGTH, t)
+
+
+### Instance Visibility Functions
+
+# Split a label map into one boolean mask per pasted character
+def get_instance_masks(lbl, n_instances):
+    '''Inputs:
+    lbl: instance-ID label map of one image (0 = background)
+    n_instances: number of characters pasted into the image'''
+    ids = np.arange(1, n_instances+1, dtype=lbl.dtype)
+    return lbl[np.newaxis,:,:] == ids[:,np.newaxis,np.newaxis]
+
+# Compute visible boxes and visibility fractions of all characters in one image
+def get_visible_instances(lbl, areas):
+    '''Inputs:
+    lbl: instance-ID label map of one image (0 = background)
+    areas: number of pixels each character covered when it was pasted
+    Outputs:
+    boxes: (n, 4) visible [x_min, y_min, x_max, y_max], zero if fully occluded
+    visibility: (n,) fraction of each character left visible
+    masks: (n, H, W) boolean visible mask of each character'''
+    masks = get_instance_masks(lbl, areas.shape[0])
+    visible = masks.sum(axis=(1,2))
+    visibility = visible / np.maximum(areas, 1)
+
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    boxes = np.stack([
+        cols.argmax(axis=1),
+        rows.argmax(axis=1),
+        cols.shape[1] - cols[:,::-1].argmax(axis=1),
+        rows.shape[1] - rows[:,::-1].argmax(axis=1),
+        ], axis=1)
+    boxes[visible == 0] = 0
+
+    return boxes, visibility, masks
+
+# Encode a boolean mask as uncompressed COCO run-length encoding
+def mask_to_rle(mask):
+    pixels = mask.flatten(order='F').astype('int8')
+    changes = np.flatnonzero(np.diff(pixels)) + 1
+    counts = np.diff(np.concatenate([[0], changes, [pixels.size]]))
+    # COCO runs always start with background
+    if pixels.size > 0 and pixels[0] == 1:
+        counts = np.concatenate([[0], counts])
+    return {"counts": counts.tolist(), "size": list(mask.shape)}
+
+
+
+### Dataset Cache
+
+# Hash of this module, so cached datasets are invalidated by code changes
+def get_code_version():
+    with open(__file__, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Hash of the glyph set contents
+def get_chars_hash(chars):
+    h = hashlib.sha1()
+    for char in chars:
+        h.update(str(len(char)).encode())
+        for some_char in char:
+            h.update("{}{}".format(some_char.mode, some_char.size).encode())
+            h.update(some_char.tobytes())
+    return h.hexdigest()
+
+def get_dataset_fingerprint(kind, dataset_size, chars, config, seed, **options):
+    '''Inputs:
+    kind: 'images' or 'bbox'
+    dataset_size: number of images
+    chars: Dataset of characters
+    config: DatasetGeneratorConfig, output and cache paths are ignored
+    seed: random seed
+    options: further generation arguments that change the output'''
+    ignored = ['DATA_PATH', 'CACHE_PATH', 'CACHE_SIZE', 'N_JOBS']
+    settings = {k: getattr(config, k) for k in dir(config) if k.isupper() and k not in ignored}
+    key = json.dumps({
+        "kind": kind,
+        "dataset_size": int(dataset_size),
+        "seed": int(seed),
+        "config": settings,
+        "options": options,
+        "code": get_code_version(),
+        "chars": get_chars_hash(chars),
+    }, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+# Outputs may be hard links into the cache, remove them before writing
+# so the cached file is never modified in place
+def unlink_output(fname):
+    if os.path.lexists(fname):
+        os.remove(fname)
+
+# Hard link a file as read-only, copy it if src and dst are on different
+# file systems. Keep CACHE_PATH next to the outputs to avoid the copy.
+def link_file(src, dst):
+    if os.path.dirname(dst) and not os.path.exists(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    unlink_output(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    # shared by output and cache, so accidental in-place writes fail loudly
+    os.chmod(dst, 0o444)
+
+def fetch_cached_dataset(config, fingerprint, dst_root):
+    '''Link a cached dataset into dst_root, returns False if it is not cached'''
+    entry = os.path.join(config.CACHE_PATH, fingerprint)
+    if not os.path.exists(os.path.join(entry, 'manifest.json')):
+        return False
+    with open(os.path.join(entry, 'manifest.json')) as f:
+        manifest = json.load(f)
+    for rel in manifest["files"]:
+        link_file(os.path.join(entry, 'data', rel), os.path.join(dst_root, rel))
+    # mark as recently used
+    os.utime(entry)
+    return True
+
+def store_cached_dataset(config, fingerprint, src_root, files):
+    '''Add the files of a finished dataset (relative to src_root) to the cache'''
+    entry = os.path.join(config.CACHE_PATH, fingerprint)
+    if os.path.exists(entry):
+        return
+    # a dataset larger than the cache would only evict everything else
+    size = sum(os.path.getsize(os.path.join(src_root, rel)) for rel in files)
+    if size > config.CACHE_SIZE:
+        print('Not cached, dataset size %d exceeds CACHE_SIZE %d'%(size, config.CACHE_SIZE))
+        return
+    tmp_entry = entry + '.tmp{}'.format(os.getpid())
+    for rel in files:
+        link_file(os.path.join(src_root, rel), os.path.join(tmp_entry, 'data', rel))
+    with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+        json.dump({"files": files, "size": size, "created": time.time()}, f)
+    # rename is atomic, a concurrent run with the same fingerprint may have won
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    evict_cache(config.CACHE_PATH, config.CACHE_SIZE, keep=fingerprint)
+
+def evict_cache(cache_path, max_size, keep=None):
+    '''Remove least recently used datasets until the cache fits into max_size bytes'''
+    entries = []
+    for name in os.listdir(cache_path):
+        manifest = os.path.join(cache_path, name, 'manifest.json')
+        if '.tmp' in name or not os.path.exists(manifest):
+            continue
+        with open(manifest) as f:
+            size = json.load(f)["size"]
+        entries.append((os.path.getmtime(os.path.join(cache_path, name)), size, name))
+
+    total = sum(e[1] for e in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_path, name), ignore_errors=True)
+        total -= size
+
+
+
+### Memory-Mapped Job Outputs
+
+def create_memmaps(out_dir, arrays):
+    '''Create empty .npy files that jobs write into directly.
+    arrays: list of (name, shape, dtype), creates out_dir/<name>.npy'''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    memmaps = []
+    for name, shape, dtype in arrays:
+        fname = os.path.join(out_dir, name + '.npy')
+        unlink_output(fname)
+        memmaps.append(np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=shape))
+    return memmaps
+
+def open_job_memmaps(out_dir, names, k, joblength):
+    '''Views of the slices of job k in the memory-mapped outputs'''
+    return [
+        np.load(os.path.join(out_dir, name + '.npy'), mmap_mode='r+')[k*joblength:(k+1)*joblength]
+        for name in names
+    ]
+
+def close_job_memmaps(memmaps, k, joblength, t):
+    '''Flush a job's slices and return its metadata instead of the data'''
+    for mm in memmaps:
+        mm.flush()
+    return {
+        "job": k,
+        "offset": k*joblength,
+        "count": joblength,
+        "md5": hashlib.md5(np.ascontiguousarray(memmaps[0])).hexdigest(),
+        "duration": time.time()-t,
+    }
+
+
+
+def check_job_results(results, n_jobs, joblength):
+    '''Check that the metadata of memory-mapped jobs covers [0, n_jobs*joblength)
+    and report their throughput. Returns the metadata sorted by offset.'''
+    jobs = sorted(results, key=lambda r: r["offset"])
+    covered = [(r["offset"], r["count"]) for r in jobs]
+    if covered != [(k*joblength, joblength) for k in range(n_jobs)]:
+        raise RuntimeError("Jobs do not cover images [0, {})".format(n_jobs*joblength))
+    rates = [r["count"]/r["duration"] for r in jobs if r["duration"] > 0]
+    if rates:
+        print("Job throughput: %.1f images/s per job (min %.1f, max %.1f)"%(np.mean(rates), min(rates), max(rates)))
+    return jobs
+
+def save_job_results(fname, jobs):
+    unlink_output(fname)
+    with open(fname, 'w') as f:
+        json.dump(jobs, f)
 
 
 
@@ -520,7 +861,10 @@ def generate_dataset(path,
                      seed=None,
                      save=True, 
                      show=False,
-                     checksum=None):
+                     checksum=None,
+                     preview=None,
+                     preview_size=100,
+                     memmap=False):
     
     '''Inputs:
     path: Save path
@@ -529,18 +873,60 @@ def generate_dataset(path,
     char_locs: legacy
     split: train/val split of drawer instances
     save: If True save dataset to path
-    show: If true plot generated images'''
+    show: If true plot a contact sheet of the generated images
+    preview: If set, save a contact sheet PNG to this file name
+    preview_size: number of images in the contact sheet
+    memmap: If True jobs write directly into memory-mapped .npy files in path
+        (a temporary directory next to it if not saving) instead of returning arrays'''
     
     t = time.time()
+
+    # Reuse a previous run with identical inputs
+    fingerprint = None
+    if config.CACHE_PATH and save and seed:
+        fingerprint = get_dataset_fingerprint('images', dataset_size, chars, config, seed)
+        if not show and not preview and fetch_cached_dataset(config, fingerprint, path):
+            print('Loaded from cache:', os.path.join(config.CACHE_PATH, fingerprint))
+            print("Duration:", time.time()-t)
+            return test_checksum(np.load(os.path.join(path, 'images.npy'), mmap_mode='r'), checksum)
     
     # Define necessary number of jobs
     N = dataset_size
     M = dataset_size//config.JOBLENGTH
     
     # Initialize data
-    data_ims = np.zeros((N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
-    data_seg = np.zeros((N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,1), dtype='uint8')
-    data_tar = np.zeros((N,config.TARGET_WIDTH,config.TARGET_HEIGHT,3), dtype='uint8')
+    out_dir = None
+    if memmap and save:
+        out_dir = path
+    elif memmap:
+        # next to the output rather than in the system tmp, which may be in RAM
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        out_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        digest = _generate_dataset(path, N, M, chars, config, seed, save, show, checksum,
+                                   preview, preview_size, out_dir, fingerprint, t)
+    finally:
+        # remove the temporary outputs even if a job failed
+        if memmap and not save:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    return digest
+
+def _generate_dataset(path, N, M, chars, config, seed, save, show, checksum,
+                      preview, preview_size, out_dir, fingerprint, t):
+    memmap = out_dir is not None
+    if memmap:
+        data_ims, data_seg, data_tar = create_memmaps(out_dir, [
+            ('images', (N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), 'uint8'),
+            ('segmentation', (N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,1), 'uint8'),
+            ('targets', (N,)+get_target_shape(config), 'uint8'),
+        ])
+    else:
+        data_ims = np.zeros((N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
+        data_seg = np.zeros((N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,1), dtype='uint8')
+        data_tar = np.zeros((N,)+get_target_shape(config), dtype='uint8')
 
     # Execute parallel data generation
     #for i in range(0,N):
@@ -550,57 +936,73 @@ def generate_dataset(path,
         np.random.seed(seed)
         print('Seed fixed')
     seeds = np.unique(np.random.randint(2**32, size=2*M))
-    results = Parallel(n_jobs=-1, verbose=50)(delayed(make_image)(chars,
+    results = Parallel(n_jobs=config.N_JOBS, verbose=50)(delayed(make_image)(chars,
                k, 
                config,
-               seed=seeds[k]) for k in range(M))
-
-    # feed results into the dataset
-    for i in range(0,M):
-        for j in range(config.JOBLENGTH):
-            data_ims[i*config.JOBLENGTH+j,:,:,:] = results[i][0][j,...] 
-            data_seg[i*config.JOBLENGTH+j,:,:,:] = results[i][1][j,...]
-            data_tar[i*config.JOBLENGTH+j,:,:,:] = results[i][2][j,...]
+               seed=seeds[k],
+               out_dir=out_dir) for k in range(M))
+
+    # feed results into the dataset, memory-mapped jobs already wrote theirs
+    files = ['images.npy', 'segmentation.npy', 'targets.npy']
+    if memmap:
+        jobs = check_job_results(results, M, config.JOBLENGTH)
+    else:
+        for i in range(0,M):
+            for j in range(config.JOBLENGTH):
+                data_ims[i*config.JOBLENGTH+j,:,:,:] = results[i][0][j,...] 
+                data_seg[i*config.JOBLENGTH+j,:,:,:] = results[i][1][j,...]
+                data_tar[i*config.JOBLENGTH+j,...] = results[i][2][j,...]
         
             
 
 
     #save dataset
     save = save
-    if save == True:
+    if save == True and memmap:
+        for data in [data_ims, data_seg, data_tar]:
+            data.flush()
+        save_job_results(os.path.join(path, 'jobs.json'), jobs)
+        files.append('jobs.json')
+        if fingerprint:
+            store_cached_dataset(config, fingerprint, path, files)
+    elif save == True:
         if not os.path.exists(path):
             os.makedirs(path)
-        np.save(path + 'images', data_ims.astype('uint8'))
-        np.save(path + 'segmentation', data_seg.astype('uint8'))
-        np.save(path + 'targets', data_tar.astype('uint8'))
+        for fname in files:
+            unlink_output(os.path.join(path, fname))
+        np.save(os.path.join(path, 'images'), data_ims.astype('uint8'))
+        np.save(os.path.join(path, 'segmentation'), data_seg.astype('uint8'))
+        np.save(os.path.join(path, 'targets'), data_tar.astype('uint8'))
+        if fingerprint:
+            store_cached_dataset(config, fingerprint, path, files)
 
     #show outputs
-    show = show
+    n = min(N, preview_size)
+    # stack multiple targets per sample vertically
+    tar = data_tar[:n].reshape((n,-1)+data_tar.shape[-2:])
     if show == True:
-        for i in range(0,N):   
-            plt.figure
-            plt.subplot(131)    
-            plt.imshow(data_tar[i,...])
-            
-            plt.subplot(132)
-            plt.imshow(data_ims[i,...])
-            
-            plt.subplot(133)
-            plt.imshow(data_seg[i,...,0])
-
-            plt.show()
+        plt.imshow(make_contact_sheet(data_ims[:n], seg=data_seg[:n], tar=tar))
+        plt.axis('off')
+        plt.show()
+    if preview:
+        save_contact_sheet(preview, data_ims[:n], seg=data_seg[:n], tar=tar)
 
 
     print("Duration:", time.time()-t)
     
-    # Test checksum
-    last_image = data_ims[-1,...]
-    print("Hash:", hashlib.md5(last_image).digest())
+    return test_checksum(data_ims, checksum)
+
+# Compare the hash of the last image with a published checksum
+def test_checksum(data_ims, checksum):
+    last_image = np.ascontiguousarray(data_ims[-1,...])
+    digest = hashlib.md5(last_image).digest()
+    print("Hash:", digest)
     if checksum:
-        if hashlib.md5(last_image).digest() == checksum:
+        if digest == checksum:
             print("Dataset was correctly created!")
         else:
             print("Incorrect hash value!")
+    return digest
             
     
     
@@ -610,7 +1012,11 @@ def generate_dataset_bbox(
     config,
     seed=None,
     save_coco_format=True,
-    show=False
+    show=False,
+    min_visibility=0.,
+    preview=None,
+    preview_size=100,
+    memmap=False
 ):
 
     '''Inputs:
@@ -620,17 +1026,59 @@ def generate_dataset_bbox(
     char_locs: legacy
     split: train/val split of drawer instances
     save: If True save dataset to path
-    show: If true plot generated images'''
+    show: If true plot a contact sheet of the generated images
+    preview: If set, save a contact sheet PNG to this file name
+    preview_size: number of images in the contact sheet
+    min_visibility: drop characters with a smaller visible fraction [0,1],
+        fully occluded characters are always dropped
+    memmap: If True jobs write directly into memory-mapped arrays in a
+        temporary directory under config.DATA_PATH instead of returning them'''
 
     t = time.time()
 
+    # Reuse a previous run with identical inputs
+    fingerprint = None
+    if config.CACHE_PATH and save_coco_format and seed:
+        fingerprint = get_dataset_fingerprint('bbox', dataset_size, chars, config, seed, min_visibility=min_visibility)
+        if not show and not preview and fetch_cached_dataset(config, fingerprint, config.DATA_PATH):
+            print('Loaded from cache:', os.path.join(config.CACHE_PATH, fingerprint))
+            print("Duration:", time.time()-t)
+            return
+
     # Define necessary number of jobs
     N = dataset_size
     M = dataset_size//config.JOBLENGTH
 
     # Initialize data
-    data_ims = np.zeros((N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
-    data_bboxes = np.zeros((N,config.DISTRACTORS,config.BBOX_DIMS+1,1), dtype='uint8')
+    out_dir = None
+    if memmap:
+        if config.DATA_PATH and not os.path.exists(config.DATA_PATH):
+            os.makedirs(config.DATA_PATH)
+        out_dir = tempfile.mkdtemp(dir=config.DATA_PATH or None)
+    try:
+        _generate_dataset_bbox(N, M, chars, config, seed, save_coco_format, show,
+                               min_visibility, preview, preview_size, out_dir, fingerprint)
+    finally:
+        # remove the temporary arrays even if a job failed
+        if memmap:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+def _generate_dataset_bbox(N, M, chars, config, seed, save_coco_format, show,
+                           min_visibility, preview, preview_size, out_dir, fingerprint):
+    memmap = out_dir is not None
+    if memmap:
+        data_ims, data_bboxes, data_lbl, data_area = create_memmaps(out_dir, [
+            ('images', (N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), 'uint8'),
+            ('bboxes', (N,config.DISTRACTORS,config.BBOX_DIMS+1,1), 'uint8'),
+            ('labels', (N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT), 'uint16'),
+            ('areas', (N,config.DISTRACTORS), 'uint16'),
+        ])
+    else:
+        data_ims = np.zeros((N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT,3), dtype='uint8')
+        data_bboxes = np.zeros((N,config.DISTRACTORS,config.BBOX_DIMS+1,1), dtype='uint8')
+        data_lbl = np.zeros((N,config.IMAGE_WIDTH,config.IMAGE_HEIGHT), dtype='uint16')
+        data_area = np.zeros((N,config.DISTRACTORS), dtype='uint16')
+    data_vis = np.zeros((N,config.DISTRACTORS), dtype='float32')
     # data_tar = np.zeros((N,config.TARGET_WIDTH,config.TARGET_HEIGHT,3), dtype='uint8')
 
     # Execute parallel data generation
@@ -642,19 +1090,36 @@ def generate_dataset_bbox(
         print('Seed fixed')
     seeds = np.unique(np.random.randint(2**32, size=2*M))
     results = Parallel(
-        n_jobs=-1,
+        n_jobs=config.N_JOBS,
         verbose=50)(delayed(make_image_bbox)(chars,
         k,
         config,
-        seed=seeds[k]) for k in range(M)
+        seed=seeds[k],
+        out_dir=out_dir) for k in range(M)
     )
 
-    # feed results into the dataset
-    for i in range(0,M):
-        for j in range(config.JOBLENGTH):
-            data_ims[i*config.JOBLENGTH+j,:,:,:] = results[i][0][j,...]
-            data_bboxes[i*config.JOBLENGTH+j,:,:,:] = results[i][1][j,...]
-            # data_tar[i*config.JOBLENGTH+j,:,:,:] = results[i][2][j,...]
+    # feed results into the dataset, memory-mapped jobs already wrote theirs
+    if memmap:
+        jobs = check_job_results(results, M, config.JOBLENGTH)
+    else:
+        for i in range(0,M):
+            for j in range(config.JOBLENGTH):
+                data_ims[i*config.JOBLENGTH+j,:,:,:] = results[i][0][j,...]
+                data_bboxes[i*config.JOBLENGTH+j,:,:,:] = results[i][1][j,...]
+                data_lbl[i*config.JOBLENGTH+j,:,:] = results[i][2][j,...]
+                data_area[i*config.JOBLENGTH+j,:] = results[i][3][j,...]
+                # data_tar[i*config.JOBLENGTH+j,:,:,:] = results[i][2][j,...]
+
+    # replace pasted boxes with visible boxes and drop occluded characters,
+    # the COCO segmentations are encoded from the same masks
+    segmentations = [] if save_coco_format else None
+    for i in range(0,N):
+        boxes, data_vis[i,:], masks = get_visible_instances(data_lbl[i,...], data_area[i,:])
+        data_bboxes[i,:,:4,0] = boxes
+        hidden = (data_vis[i,:] <= 0) | (data_vis[i,:] < min_visibility)
+        data_bboxes[i,hidden,:,0] = 0
+        if save_coco_format:
+            segmentations.append([None if hidden[j] else mask_to_rle(masks[j]) for j in range(masks.shape[0])])
 
     # #save dataset
     # save = save
@@ -666,43 +1131,60 @@ def generate_dataset_bbox(
         # np.save(path + 'targets', data_tar.astype('uint8'))
 
     if save_coco_format:
-        save_coco(config, data_ims.astype('uint8'), data_bboxes.astype('uint8'))
+        save_coco(config, data_ims, data_bboxes, segmentations=segmentations, visibility=data_vis)
+        save_class_index(config, build_class_index(data_bboxes, config.NUM_CLASSES))
+        files = [get_coco_json_path(config), get_class_index_path(config)]
+        if memmap:
+            save_job_results(get_jobs_path(config), jobs)
+            files.append(get_jobs_path(config))
+        if fingerprint:
+            files = [os.path.relpath(f, config.DATA_PATH or '.') for f in files]
+            files += [os.path.join(config.DRAWER_SPLIT, get_coco_file_name(config, i+1)) for i in range(N)]
+            store_cached_dataset(config, fingerprint, config.DATA_PATH, files)
 
     #show outputs
-    show = show
+    n = min(N, preview_size)
     if show == True:
-        for i in range(0,N):
-            plt.figure
-            plt.subplot(121)
-            plt.imshow(data_ims[i,...])
-            # plt.imshow(data_tar[i,...])
-
-            plt.subplot(122)
-            plt.imshow(data_ims[i,...])
-            # boxes = data_bboxes[i,:,:4,:].tolist()
-            show_boxes_white(data_bboxes[i,:,:4,:].tolist())
-
-            # plt.subplot(133)
-            # show_boxes_white(data_bboxes[i,:,:4,:].tolist())
-            # plt.imshow(data_seg[i,...,0])
+        plt.imshow(make_contact_sheet(data_ims[:n], boxes=data_bboxes[:n], seg=data_lbl[:n]))
+        plt.axis('off')
+        plt.show()
+    if preview:
+        save_contact_sheet(preview, data_ims[:n], boxes=data_bboxes[:n], seg=data_lbl[:n])
 
-            plt.show()
-
-def save_coco(config, ims, boxes):
+def save_coco(config, ims, boxes, segmentations=None, visibility=None):
     if not os.path.exists(os.path.join(config.DATA_PATH,config.DRAWER_SPLIT)):
         os.makedirs(os.path.join(config.DATA_PATH,config.DRAWER_SPLIT))
     # modify paths
-    dst_json = config.DATA_PATH + "{}_{}_characters_bbox_{}.json".format(
+    dst_json = get_coco_json_path(config)
+    data = get_coco_data(config, ims, boxes, segmentations=segmentations, visibility=visibility)
+    unlink_output(dst_json)
+    with open(dst_json, "w") as coco_file:
+        coco_file.write(json.dumps(data))
+
+def get_coco_json_path(config):
+    return config.DATA_PATH + "{}_{}_characters_bbox_{}.json".format(
+        config.PREFIX,
+        config.DISTRACTORS,
+        config.DRAWER_SPLIT
+    )
+
+def get_jobs_path(config):
+    return config.DATA_PATH + "{}_{}_characters_bbox_{}_jobs.json".format(
         config.PREFIX,
         config.DISTRACTORS,
         config.DRAWER_SPLIT
     )
-    data = get_coco_data(config, ims, boxes)
-    with open(dst_json, "w") as coco_file:
-        coco_file.write(json.dumps(data))
 
-def get_coco_data(config, ims, boxes):
-    images,annotations = get_coco_images_and_annotations(config, ims, boxes)
+def get_coco_file_name(config, img_id):
+    return "{}_{}_characters_bbox_{}_{}.jpg".format(
+        config.PREFIX,
+        config.DISTRACTORS,
+        config.DRAWER_SPLIT,
+        str(img_id).zfill(12)
+    )
+
+def get_coco_data(config, ims, boxes, segmentations=None, visibility=None):
+    images,annotations = get_coco_images_and_annotations(config, ims, boxes, segmentations=segmentations, visibility=visibility)
     categories = get_coco_categories(config)
     return {
         "images": images,
@@ -715,19 +1197,20 @@ def get_coco_categories(config):
         {'id':str(i),'name':str(i),'supercategory':'None'} for i in range(1,config.NUM_CLASSES+1)
     ]
 
-def get_coco_images_and_annotations(config, ims, boxes):
+def get_coco_images_and_annotations(config, ims, boxes, segmentations=None, visibility=None):
+    '''Inputs:
+    ims: images
+    boxes: [x_min, y_min, x_max, y_max, class] per character, all zero if dropped
+    segmentations: optional RLE of the visible mask per image and character,
+        as encoded by mask_to_rle, replaces the box polygons
+    visibility: optional visible fraction per character'''
     images,annotations = [],[]
     ann_counter = 0
     for i in range(0,ims.shape[0]):
         img_id = i+1
         image_dict = {}
         image_dict["license"] = 1
-        image_dict["file_name"] = "{}_{}_characters_bbox_{}_{}.jpg".format(
-            config.PREFIX,
-            config.DISTRACTORS,
-            config.DRAWER_SPLIT,
-            str(img_id).zfill(12)
-        )
+        image_dict["file_name"] = get_coco_file_name(config, img_id)
         image_dict["coco_url"] = ""
         image_dict["width"] = ims.shape[2]
         image_dict["height"] = ims.shape[1]
@@ -736,14 +1219,13 @@ def get_coco_images_and_annotations(config, ims, boxes):
         image_dict["id"] = img_id
         images.append(image_dict)
         new_image = convertToJpeg(ims[i,...])
-        with open(
-            os.path.join(
-                config.DATA_PATH,
-                config.DRAWER_SPLIT,
-                image_dict["file_name"],
-            ),
-            "wb",
-        ) as image_file:
+        dst_image = os.path.join(
+            config.DATA_PATH,
+            config.DRAWER_SPLIT,
+            image_dict["file_name"],
+        )
+        unlink_output(dst_image)
+        with open(dst_image, "wb") as image_file:
             image_file.write(new_image)
 
         # for j in range(boxes[i,:,:4,:]):
@@ -764,6 +1246,13 @@ def get_coco_images_and_annotations(config, ims, boxes):
                 [x_min, y_min, x_min, y_max, x_max, y_max, x_max, y_min]
             ]
             annotation_dict["area"] = w * h
+            if segmentations is not None:
+                rle = segmentations[i][j]
+                annotation_dict["segmentation"] = rle
+                # runs alternate background/foreground, starting with background
+                annotation_dict["area"] = int(sum(rle["counts"][1::2]))
+            if visibility is not None:
+                annotation_dict["visibility"] = float(visibility[i,j])
             annotation_dict["iscrowd"] = 0
             annotation_dict["image_id"] = img_id
             annotation_dict["category_id"] = class_id
@@ -773,8 +1262,118 @@ def get_coco_images_and_annotations(config, ims, boxes):
 
     return images, annotations
 
+### Class Index and Sampling
+
+def get_class_index_path(config):
+    return config.DATA_PATH + "{}_{}_characters_bbox_{}_index.npz".format(
+        config.PREFIX,
+        config.DISTRACTORS,
+        config.DRAWER_SPLIT
+    )
+
+def build_class_index(boxes, n_classes):
+    '''Inputs:
+    boxes: (N, DISTRACTORS, BBOX_DIMS+1, 1) boxes as written by save_coco,
+        all zero for dropped characters
+    n_classes: minimum number of classes in the index
+    Outputs a dict of compact arrays, classes are 0-based (category_id - 1)
+    and image/annotation ids match the COCO json:
+    class_ann_offsets, class_ann_ids, class_ann_image_ids: annotations of class c
+        are class_ann_ids[class_ann_offsets[c]:class_ann_offsets[c+1]]
+    class_img_offsets, class_img_ids: same layout for the images containing class c
+    image_class_hist: (N, n_classes) number of instances of each class per image'''
+    n_images, n_boxes = boxes.shape[0], boxes.shape[1]
+    valid = np.any(boxes[:,:,:4,0] != 0, axis=2).ravel()
+    flat = np.flatnonzero(valid)
+    cls = boxes[:,:,4,0].ravel()[flat].astype('int64')
+    n_classes = max(n_classes, int(cls.max())+1 if cls.size else 0)
+
+    # annotation ids follow the counter in get_coco_images_and_annotations
+    order = np.argsort(cls, kind='stable')
+    ann_counts = np.bincount(cls, minlength=n_classes)
+    class_ann_offsets = np.concatenate([[0], np.cumsum(ann_counts)])
+
+    img = flat // n_boxes
+    hist = np.bincount(img*n_classes + cls, minlength=n_images*n_classes)
+    hist = hist.reshape(n_images, n_classes)
+    hist_cls, hist_img = np.nonzero(hist.T)
+    class_img_offsets = np.concatenate([[0], np.cumsum(np.bincount(hist_cls, minlength=n_classes))])
+
+    return {
+        "class_ann_offsets": class_ann_offsets.astype('int32'),
+        "class_ann_ids": (flat[order]+1).astype('int32'),
+        "class_ann_image_ids": (img[order]+1).astype('int32'),
+        "class_img_offsets": class_img_offsets.astype('int32'),
+        "class_img_ids": (hist_img+1).astype('int32'),
+        "image_class_hist": hist.astype('uint16'),
+    }
+
+def save_class_index(config, index):
+    if not os.path.exists(config.DATA_PATH) and config.DATA_PATH:
+        os.makedirs(config.DATA_PATH)
+    unlink_output(get_class_index_path(config))
+    np.savez(get_class_index_path(config), **index)
+
+def load_class_index(path):
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+class ClassIndexSampler():
+    '''Draws class-balanced batches and few-shot episodes from a class index.
+    Every draw costs O(batch) regardless of the dataset size.'''
+
+    def __init__(self, index, seed=None):
+        self.index = index
+        self.rng = np.random.RandomState(seed)
+        self.ann_counts = np.diff(index["class_ann_offsets"])
+        self.classes = np.flatnonzero(self.ann_counts > 0)
+
+    def sample_class_balanced(self, batch_size):
+        '''Draw batch_size annotations, each from a uniformly chosen class.
+        Returns (classes, annotation ids, image ids).'''
+        cls = self.classes[self.rng.randint(0, len(self.classes), size=batch_size)]
+        start = self.index["class_ann_offsets"][cls]
+        pos = start + (self.rng.rand(batch_size)*self.ann_counts[cls]).astype('int64')
+        return cls, self.index["class_ann_ids"][pos], self.index["class_ann_image_ids"][pos]
+
+    def sample_episode(self, n_way, k_shot, n_query=0):
+        '''Draw n_way distinct classes with k_shot + n_query distinct annotations each.
+        Returns (classes, (n_way, k_shot) support annotation ids, (n_way, k_shot)
+        support image ids, (n_way, n_query) query annotation ids,
+        (n_way, n_query) query image ids).'''
+        n = k_shot + n_query
+        eligible = self.classes[self.ann_counts[self.classes] >= n]
+        if len(eligible) < n_way:
+            raise ValueError("Only {} classes have at least {} instances".format(len(eligible), n))
+        cls = self.rng.choice(eligible, size=n_way, replace=False)
+        pos = np.array([self._sample_range(self.ann_counts[c], n) for c in cls], dtype='int64').reshape(n_way, n)
+        pos = self.index["class_ann_offsets"][cls][:,np.newaxis] + pos
+        ids = self.index["class_ann_ids"][pos]
+        img_ids = self.index["class_ann_image_ids"][pos]
+        return cls, ids[:,:k_shot], img_ids[:,:k_shot], ids[:,k_shot:], img_ids[:,k_shot:]
+
+    def _sample_range(self, count, k):
+        # Floyd's algorithm: k distinct integers from range(count) in O(k)
+        chosen = []
+        seen = set()
+        for j in range(count-k, count):
+            t = self.rng.randint(0, j+1)
+            if t in seen:
+                t = j
+            seen.add(t)
+            chosen.append(t)
+        return chosen
+
 ### Data loader
 
+def load_omniglot_chars(omniglot_dir, split):
+    '''Load the characters written by get_omniglot.ipynb as one flat list.
+    split: train, eval or test'''
+    with open(os.path.join(omniglot_dir, 'chars_{}.pickle'.format(split)), 'rb') as fp:
+        chars = pickle.load(fp)
+    # flatten alphabets into one list of characters
+    return [char for alph in chars for char in alph]
+
 def load_dataset(dataset_dir, subset):
 
     assert subset in ['train', 'val-train', 'test-train', 'val-one-shot', 'test-one-shot']
@@ -788,6 +1387,213 @@ def load_dataset(dataset_dir, subset):
 
     return ims, seg, tar
 
+def build_coco_index(json_path):
+    '''Parse a COCO json written by save_coco into compact arrays:
+    image_ids, file_names: one entry per image
+    ann_offsets: annotations of image i are ann_*[ann_offsets[i]:ann_offsets[i+1]]
+    ann_ids, ann_boxes ([x_min, y_min, x_max, y_max]), ann_classes (category_id)'''
+    with open(json_path) as f:
+        data = json.load(f)
+    images = sorted(data["images"], key=lambda im: im["id"])
+    image_ids = np.array([im["id"] for im in images], dtype='int64')
+    file_names = np.array([im["file_name"] for im in images])
+
+    anns = data["annotations"]
+    ann_image = np.searchsorted(image_ids, np.array([a["image_id"] for a in anns], dtype='int64'))
+    order = np.argsort(ann_image, kind='stable')
+    ann_ids = np.array([a["id"] for a in anns], dtype='int64').reshape(-1)[order]
+    ann_boxes = np.array([a["bbox"] for a in anns], dtype='float32').reshape(-1,4)[order]
+    ann_boxes[:,2:] += ann_boxes[:,:2]
+    ann_classes = np.array([int(a["category_id"]) for a in anns], dtype='int32').reshape(-1)[order]
+    ann_offsets = np.concatenate([[0], np.cumsum(np.bincount(ann_image, minlength=len(images)))])
+
+    return {
+        "image_ids": image_ids,
+        "file_names": file_names,
+        "ann_offsets": ann_offsets.astype('int64'),
+        "ann_ids": ann_ids,
+        "ann_boxes": ann_boxes,
+        "ann_classes": ann_classes,
+    }
+
+def load_coco_index(json_path):
+    '''Load the index of a COCO json from <json>.index.npz, rebuild it if the json changed'''
+    index_path = json_path + '.index.npz'
+    stat = os.stat(json_path)
+    if os.path.exists(index_path):
+        with np.load(index_path) as f:
+            index = {k: f[k] for k in f.files}
+        # indexes without the json stamp are treated as stale
+        if index.pop("json_mtime", None) == stat.st_mtime_ns and index.pop("json_size", None) == stat.st_size:
+            return index
+
+    index = build_coco_index(json_path)
+    tmp_path = index_path + '.tmp{}.npz'.format(os.getpid())
+    try:
+        np.savez(tmp_path, json_mtime=stat.st_mtime_ns, json_size=stat.st_size, **index)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # e.g. read-only dataset directory, keep the index in memory only
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return index
+
+class CocoBboxLoader():
+    '''Batched loader for the COCO output of generate_dataset_bbox.
+    JPEGs are decoded in a thread pool, up to cache_size decoded images are
+    kept in an LRU cache so repeated epochs over small splits skip decoding.'''
+
+    def __init__(self, json_path, image_dir, num_workers=8, cache_size=0):
+        self.index = load_coco_index(json_path)
+        self.image_dir = image_dir
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index["image_ids"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''Stop the decoding threads and drop the cached images'''
+        self.pool.shutdown(wait=True)
+        with self.lock:
+            self.cache.clear()
+
+    def load_image(self, i):
+        with self.lock:
+            if i in self.cache:
+                self.cache.move_to_end(i)
+                return self.cache[i]
+        with Image.open(os.path.join(self.image_dir, self.index["file_names"][i])) as im:
+            im = np.asarray(im.convert('RGB'))
+        if self.cache_size > 0:
+            with self.lock:
+                self.cache[i] = im
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return im
+
+    def get_batch(self, indices):
+        '''Inputs:
+        indices: positions of the images (image id - 1 for save_coco output)
+        Outputs:
+        ims: (B, H, W, 3) uint8 images
+        boxes: (B, max_boxes, 4) [x_min, y_min, x_max, y_max], zero padded
+        classes: (B, max_boxes) category ids, 0 for padding
+        counts: (B,) number of boxes per image'''
+        indices = np.asarray(indices, dtype='int64')
+        ims = np.stack(list(self.pool.map(self.load_image, indices.tolist())))
+
+        start = self.index["ann_offsets"][indices]
+        counts = self.index["ann_offsets"][indices+1] - start
+        max_boxes = int(counts.max()) if len(counts) else 0
+        # gather all boxes of the batch with one fancy index
+        pos = start[:,np.newaxis] + np.arange(max_boxes)
+        valid = np.arange(max_boxes) < counts[:,np.newaxis]
+        pos = np.where(valid, pos, 0)
+        boxes = np.where(valid[...,np.newaxis], self.index["ann_boxes"][pos], 0).astype('float32')
+        classes = np.where(valid, self.index["ann_classes"][pos], 0).astype('int32')
+
+        return ims, boxes, classes, counts
+
+    def iterate_batches(self, batch_size, shuffle=False, seed=None):
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.RandomState(seed).shuffle(order)
+        for i in range(0, len(order), batch_size):
+            yield self.get_batch(order[i:i+batch_size])
+
+def load_dataset_bbox(config, **kwargs):
+    '''Loader for the dataset written by generate_dataset_bbox with this config'''
+    return CocoBboxLoader(
+        get_coco_json_path(config),
+        os.path.join(config.DATA_PATH, config.DRAWER_SPLIT),
+        **kwargs
+    )
+
+### Contact Sheet Preview
+
+# Fixed overlay colors, indexed by segmentation / instance id
+PREVIEW_PALETTE = ((np.random.RandomState(0).rand(256,3)*0.6+0.4)*255).astype('float32')
+
+def draw_box_outlines(ims, boxes, color=(255,255,255)):
+    '''Draw one pixel wide box outlines in place, all boxes at once.
+    ims: (n, H, W, 3) images
+    boxes: (n, D, >=4, ...) [x_min, y_min, x_max, y_max, ...], all zero boxes are skipped'''
+    n, h, w = ims.shape[:3]
+    boxes = np.asarray(boxes).reshape(boxes.shape[0], boxes.shape[1], -1)[:,:,:4].astype('int64')
+    img_idx, box_idx = np.nonzero(boxes.any(axis=2))
+    x0, y0, x1, y1 = boxes[img_idx, box_idx].T
+    x0, y0 = np.clip(x0, 0, w-1), np.clip(y0, 0, h-1)
+    x1, y1 = np.clip(x1-1, 0, w-1), np.clip(y1-1, 0, h-1)
+
+    # horizontal edges
+    xs = np.arange(w)
+    k, x = np.nonzero((xs >= x0[:,np.newaxis]) & (xs <= x1[:,np.newaxis]))
+    ims[img_idx[k], y0[k], x] = color
+    ims[img_idx[k], y1[k], x] = color
+    # vertical edges
+    ys = np.arange(h)
+    k, y = np.nonzero((ys >= y0[:,np.newaxis]) & (ys <= y1[:,np.newaxis]))
+    ims[img_idx[k], y, x0[k]] = color
+    ims[img_idx[k], y, x1[k]] = color
+
+def make_contact_sheet(ims, boxes=None, seg=None, tar=None, cols=None, pad=2, alpha=0.4):
+    '''Render a grid montage of images into a single uint8 array.
+    ims: (n, H, W, 3) images
+    boxes: optional (n, D, >=4, ...) boxes, drawn as outlines
+    seg: optional (n, H, W[, 1]) segmentation masks or instance-ID label maps,
+        nonzero pixels are tinted with a color per id
+    tar: optional (n, TH, TW, 3) targets, placed left of each image
+    cols: number of grid columns, defaults to a square grid'''
+    n, h, w = ims.shape[:3]
+
+    # one cell per sample: [target | image]
+    cell_h, cell_w = h, w
+    if tar is not None:
+        cell_h = max(h, tar.shape[1])
+        cell_w = w + tar.shape[2] + pad
+
+    cols = cols or int(np.ceil(np.sqrt(n)))
+    rows = int(np.ceil(n/cols))
+    # gray grid lines between cells
+    sheet = np.full((rows*(cell_h+pad), cols*(cell_w+pad), 3), 96, dtype='uint8')
+    grid = sheet.reshape(rows, cell_h+pad, cols, cell_w+pad, 3)
+
+    # render one grid row at a time, so only a row of samples is ever copied
+    for r in range(rows):
+        lo, hi = r*cols, min(n, (r+1)*cols)
+        cells = grid[r,:cell_h,:hi-lo,:cell_w]
+        cells[...] = 0
+
+        img = np.array(ims[lo:hi], dtype='uint8')
+        if seg is not None:
+            ids = np.asarray(seg[lo:hi]).reshape(hi-lo, h, w)
+            stuff = ids > 0
+            tint = PREVIEW_PALETTE[ids[stuff].astype('int64') % len(PREVIEW_PALETTE)]
+            img[stuff] = ((1-alpha)*img[stuff] + alpha*tint).astype('uint8')
+        if boxes is not None:
+            draw_box_outlines(img, boxes[lo:hi])
+
+        cells[:h,:,cell_w-w:] = img.transpose(1,0,2,3)
+        if tar is not None:
+            cells[:tar.shape[1],:,:tar.shape[2]] = np.asarray(tar[lo:hi]).transpose(1,0,2,3)
+
+    return sheet
+
+def save_contact_sheet(fname, ims, **kwargs):
+    '''Write make_contact_sheet(ims, **kwargs) to a PNG file'''
+    if os.path.dirname(fname) and not os.path.exists(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    Image.fromarray(make_contact_sheet(ims, **kwargs)).save(fname, format="PNG")
+
 def show_boxes(boxes, color):
     """
     Display the specified boxes.
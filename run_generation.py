@@ -0,0 +1,309 @@
+'''Generate datasets headless from a declarative JSON plan.
+
+    python -m run_generation plans/cluttered_omniglot.json
+    python -m run_generation plans/cluttered_omniglot_bbox.json --dry-run
+
+A plan lists clutter levels and splits, every (level, split) pair is one
+run. See plans/ for the plans reproducing the notebooks' datasets.'''
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import traceback
+
+import dataset_utils
+
+
+FORMATS = ['images', 'bbox']
+DRAWER_SPLITS = ['all', 'train', 'val']
+CHAR_SPLITS = ['train', 'eval', 'test']
+# integer defaults in DatasetGeneratorConfig that also accept fractional values
+FLOAT_SETTINGS = ['EMPTY', 'MAX_ROTATION', 'MAX_SHEAR', 'MAX_SCALE']
+# settings that have to be positive
+POSITIVE_SETTINGS = ['IMAGE_WIDTH', 'IMAGE_HEIGHT', 'TARGET_WIDTH', 'TARGET_HEIGHT',
+                     'JOBLENGTH', 'NUM_CLASSES', 'TARGETS_PER_SAMPLE', 'CACHE_SIZE']
+
+
+### Plan validation
+
+def load_plan(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+def validate_plan(plan):
+    '''Check the whole plan before anything is generated.
+    Raises ValueError listing every problem found.'''
+    errors = []
+
+    if plan.get('format') not in FORMATS:
+        errors.append("format has to be one of {}".format(FORMATS))
+    for key in ['omniglot_dir', 'output_dir']:
+        if not isinstance(plan.get(key), str):
+            errors.append("{} has to be a path".format(key))
+
+    config = dataset_utils.DatasetGeneratorConfig()
+    for key, value in plan.get('config', {}).items():
+        if not key.isupper() or not hasattr(config, key):
+            errors.append("config: unknown setting {}".format(key))
+        elif not is_valid_setting(key, value, getattr(config, key)):
+            errors.append("config: invalid value {!r} for {} (default {!r}{})".format(
+                value, key, getattr(config, key), ', has to be positive' if key in POSITIVE_SETTINGS else ''))
+    joblength = plan.get('config', {}).get('JOBLENGTH', config.JOBLENGTH)
+
+    workers = plan.get('workers')
+    if workers is not None and (not is_int(workers) or workers == 0):
+        errors.append("workers has to be a non-zero integer (negative counts from the number of cores)")
+    if not isinstance(plan.get('memmap', False), bool):
+        errors.append("memmap has to be true or false")
+    min_visibility = plan.get('min_visibility', 0.)
+    if not is_number(min_visibility) or not 0 <= min_visibility <= 1:
+        errors.append("min_visibility has to be a number in [0, 1]")
+    num_chars = plan.get('num_chars')
+    if num_chars is not None and (not is_int(num_chars) or num_chars <= 0):
+        errors.append("num_chars has to be a positive integer")
+
+    levels = plan.get('clutter_levels', [])
+    if not levels:
+        errors.append("clutter_levels must not be empty")
+    for level in levels:
+        if not is_int(level.get('distractors')) or level['distractors'] < 0:
+            errors.append("clutter level {}: distractors has to be a non-negative integer".format(level.get('name')))
+
+    splits = plan.get('splits', [])
+    if not splits:
+        errors.append("splits must not be empty")
+    names = [split.get('name') for split in splits]
+    if len(set(names)) != len(names):
+        errors.append("split names have to be unique")
+    # bbox outputs are named after the drawer split, two splits would overwrite each other
+    drawer_splits = [split.get('drawer_split') for split in splits]
+    if plan.get('format') == 'bbox' and len(set(drawer_splits)) != len(drawer_splits):
+        errors.append("bbox splits have to use distinct drawer_splits, they share one output directory")
+    for split in splits:
+        name = split.get('name')
+        if split.get('drawer_split') not in DRAWER_SPLITS:
+            errors.append("split {}: drawer_split has to be one of {}".format(name, DRAWER_SPLITS))
+        if split.get('chars') not in CHAR_SPLITS:
+            errors.append("split {}: chars has to be one of {}".format(name, CHAR_SPLITS))
+        elif isinstance(plan.get('omniglot_dir'), str):
+            fname = os.path.join(plan['omniglot_dir'], 'chars_{}.pickle'.format(split['chars']))
+            if not os.path.exists(fname):
+                errors.append("split {}: {} does not exist".format(name, fname))
+        if ('size' in split) == ('instances' in split):
+            errors.append("split {}: set exactly one of size and instances".format(name))
+        elif not is_int(split.get('size', split.get('instances'))):
+            errors.append("split {}: size/instances has to be an integer".format(name))
+        if not is_int(split.get('seed')) or split['seed'] <= 0:
+            errors.append("split {}: seed has to be a positive integer".format(name))
+
+    # bbox generation has no image checksum, and a key that matches no run
+    # would silently skip the verification
+    if plan.get('checksums') and plan.get('format') == 'bbox':
+        errors.append("checksums are only verified for the images format")
+    level_names = [str(level.get('name', level.get('distractors'))) for level in levels]
+    for level_name, level_checksums in plan.get('checksums', {}).items():
+        if level_name not in level_names:
+            errors.append("checksums {}: no such clutter level".format(level_name))
+        for split_name, checksum in level_checksums.items():
+            if split_name not in names:
+                errors.append("checksums {}/{}: no such split".format(level_name, split_name))
+            try:
+                assert len(bytes.fromhex(checksum)) == 16
+            except (AssertionError, ValueError, TypeError):
+                errors.append("checksums {}/{}: not an md5 hex digest".format(level_name, split_name))
+
+    if not errors and is_int(joblength):
+        for run in expand_runs(plan):
+            if run['size'] <= 0 or run['size'] % joblength != 0:
+                errors.append("{}/{}: dataset size {} has to be a positive multiple of JOBLENGTH {}".format(
+                    run['level'], run['split'], run['size'], joblength))
+
+    if errors:
+        raise ValueError("Invalid plan:\n  " + "\n  ".join(errors))
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_number(value):
+    return is_int(value) or isinstance(value, float)
+
+def is_valid_setting(key, value, default):
+    '''Check a config override against the type of its default'''
+    if isinstance(default, bool):
+        return isinstance(value, bool)
+    if is_int(default):
+        valid = is_number(value) if key in FLOAT_SETTINGS else is_int(value)
+        if key == 'N_JOBS':
+            valid = valid and value != 0
+        return valid and (key not in POSITIVE_SETTINGS or value > 0)
+    return isinstance(value, type(default))
+
+def expand_runs(plan):
+    '''One run per (clutter level, split)'''
+    runs = []
+    for level in plan['clutter_levels']:
+        level_name = str(level.get('name', level['distractors']))
+        checksums = plan.get('checksums', {}).get(level_name, {})
+        for split in plan['splits']:
+            if 'size' in split:
+                size = split['size']
+            else:
+                size = split['instances'] // max(level['distractors'], 1)
+            if plan['format'] == 'images':
+                path = os.path.join(plan['output_dir'], '{}_characters'.format(level_name), split['name'], '')
+            else:
+                path = os.path.join(plan['output_dir'], '{}_characters_bbox'.format(level_name), '')
+            runs.append({
+                'level': level_name,
+                'split': split['name'],
+                'distractors': level['distractors'],
+                'drawer_split': split['drawer_split'],
+                'chars': split['chars'],
+                'size': size,
+                'seed': split['seed'],
+                'path': path,
+                'checksum': checksums.get(split['name']),
+            })
+    return runs
+
+
+
+### Plan execution
+
+def make_config(plan, run):
+    config = dataset_utils.DatasetGeneratorConfig()
+    for key, value in plan.get('config', {}).items():
+        setattr(config, key, value)
+    if plan.get('workers') is not None:
+        config.N_JOBS = plan['workers']
+    config.DISTRACTORS = run['distractors']
+    config.DRAWER_SPLIT = run['drawer_split']
+    config.set_drawer_split()
+    if plan['format'] == 'bbox':
+        config.DATA_PATH = run['path']
+    return config
+
+def execute_run(plan, run, chars):
+    config = make_config(plan, run)
+    checksum = bytes.fromhex(run['checksum']) if run['checksum'] else None
+    if plan['format'] == 'images':
+        digest = dataset_utils.generate_dataset(
+            run['path'], run['size'], chars, config,
+            seed=run['seed'],
+            checksum=checksum,
+            memmap=plan.get('memmap', False))
+    else:
+        digest = None
+        dataset_utils.generate_dataset_bbox(
+            run['size'], chars, config,
+            seed=run['seed'],
+            min_visibility=plan.get('min_visibility', 0.),
+            memmap=plan.get('memmap', False))
+    return digest
+
+def run_plan(plan, dry_run=False, summary_path=None):
+    validate_plan(plan)
+    runs = expand_runs(plan)
+    total_images = sum(run['size'] for run in runs)
+    print('Plan: {} runs, {} images'.format(len(runs), total_images))
+    if dry_run:
+        for run in runs:
+            print('  {level}/{split}: {size} images, {distractors} distractors, seed {seed} -> {path}'.format(**run))
+        return None
+
+    t = time.time()
+    summary_path = summary_path or os.path.join(plan['output_dir'], 'run_summary.json')
+    results = []
+    summary = {
+        'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)),
+        'code_version': dataset_utils.get_code_version(),
+        'plan': plan,
+        'runs': results,
+        'failed': None,
+    }
+    chars_cache = {}
+    done_images = 0
+    run = None
+    try:
+        for i, run in enumerate(runs):
+            if run['chars'] not in chars_cache:
+                chars = dataset_utils.load_omniglot_chars(plan['omniglot_dir'], run['chars'])
+                if plan.get('num_chars'):
+                    chars = chars[:plan['num_chars']]
+                chars_cache[run['chars']] = chars
+
+            print('')
+            print('[{}/{}] Generating {}/{} -> {}'.format(i+1, len(runs), run['level'], run['split'], run['path']))
+            t_run = time.time()
+            digest = execute_run(plan, run, chars_cache[run['chars']])
+            duration = time.time()-t_run
+            done_images += run['size']
+
+            result = copy.copy(run)
+            result['duration'] = duration
+            result['images_per_second'] = run['size']/duration if duration > 0 else None
+            result['hash'] = digest.hex() if digest else None
+            result['checksum_ok'] = (digest.hex() == run['checksum']) if run['checksum'] and digest else None
+            results.append(result)
+            # keep the summary current, a later failure must not lose finished runs
+            write_summary(summary_path, summary, t, done_images)
+
+            elapsed = time.time()-t
+            print('[{}/{}] {:.1f}s, {:.1f} images/s, {}/{} images done, {:.0f}s elapsed'.format(
+                i+1, len(runs), duration, result['images_per_second'] or 0, done_images, total_images, elapsed))
+    except BaseException as e:
+        summary['failed'] = {
+            'level': run['level'] if run else None,
+            'split': run['split'] if run else None,
+            'error': repr(e),
+            'traceback': traceback.format_exc(),
+        }
+        raise
+    finally:
+        write_summary(summary_path, summary, t, done_images)
+        print('')
+        print('Summary written to', summary_path)
+
+    print('All Done')
+    return summary
+
+def write_summary(summary_path, summary, t, done_images):
+    summary['duration'] = time.time()-t
+    summary['images'] = done_images
+    summary['images_per_second'] = done_images/summary['duration'] if summary['duration'] > 0 else None
+    if os.path.dirname(summary_path) and not os.path.exists(os.path.dirname(summary_path)):
+        os.makedirs(os.path.dirname(summary_path))
+    # write and rename, so an interrupted write never leaves a truncated summary
+    with open(summary_path + '.tmp', 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(summary_path + '.tmp', summary_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('plan', help='JSON plan file')
+    parser.add_argument('--dry-run', action='store_true', help='validate the plan and list its runs')
+    parser.add_argument('--workers', type=int, help='override the number of parallel workers')
+    parser.add_argument('--summary', help='run summary file (default: <output_dir>/run_summary.json)')
+    args = parser.parse_args(argv)
+
+    plan = load_plan(args.plan)
+    if args.workers is not None:
+        plan['workers'] = args.workers
+    try:
+        validate_plan(plan)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    summary = run_plan(plan, dry_run=args.dry_run, summary_path=args.summary)
+    failed = ['{level}/{split}'.format(**r) for r in (summary or {}).get('runs', []) if r['checksum_ok'] is False]
+    if failed:
+        print('Incorrect hash value for', ', '.join(failed), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())